@@ -5,15 +5,98 @@ Backtesting a short straddle strategy
 import argparse
 import datetime
 import logging
+import os
 from datetime import time
 
 import backtrader as bt
+import numpy as np
 import pandas as pd
 
 from const import LOT_SIZE
+from straddle_kernels import KERNELS_DIGEST
+from straddle_kernels import sweep
+
+## Ahead of time build of the kernel, see compile_kernels.py. Used only when
+## built from the current straddle_kernels.py, sweep always runs the JIT
+## kernels and a stale build would disagree with it
+try:
+    import straddle_ext
+except ImportError:
+    straddle_ext = None
+
+AOT_KERNEL = getattr(straddle_ext, "kernels_digest", lambda: None)() == KERNELS_DIGEST
+if AOT_KERNEL:
+    from straddle_ext import run_straddle
+else:
+    from straddle_kernels import run_straddle
+
+## Flat fee in INR per order
+FLAT_FEE = 10
+
+
+def read_feed(file_name: str, columns: list = None) -> pd.DataFrame:
+    """
+    Read the minute data csv of a strike, using the multithreaded pyarrow
+    parser. The parsed frame is cached as parquet next to the csv so later
+    runs skip the csv parsing altogether, reading the cache memory mapped
+    """
+    parquet_file = f"{file_name}.parquet"
+    if os.path.exists(parquet_file) and os.path.getmtime(
+        parquet_file
+    ) >= os.path.getmtime(file_name):
+        return pd.read_parquet(parquet_file, columns=columns, memory_map=True)
+    df = pd.read_csv(file_name, engine="pyarrow", parse_dates=True, index_col=0)
+    df.to_parquet(parquet_file)
+    return df[columns] if columns else df
+
+
+def align_feeds(ce_df: pd.DataFrame, pe_df: pd.DataFrame):
+    """
+    Forward fill both the feeds on to one shared minute index spanning
+    the period covered by both
+    """
+    start_time = max(ce_df.index[0], pe_df.index[0])
+    end_time = min(ce_df.index[-1], pe_df.index[-1])
+    minute_index = pd.date_range(start_time, end_time, freq="1min")
+    return (
+        ce_df.reindex(minute_index, method="ffill"),
+        pe_df.reindex(minute_index, method="ffill"),
+    )
+
+
+def entry_mask(ce, pe, minutes, thresh_diff, entry_min):
+    """
+    Bars where the straddle can be placed, at or after entry_min and the
+    difference between the premiums within thresh_diff of their average
+    """
+    return (minutes >= entry_min) & (np.abs(ce - pe) * 2 <= thresh_diff * (ce + pe))
+
+
+class _StraddleState:
+    """State of the straddle, slots keep the per bar lookups cheap"""
+
+    __slots__ = (
+        "ce_avg",
+        "pe_avg",
+        "ce_sl",
+        "pe_sl",
+        "target",
+        "mtm",
+        "straddle_premium",
+        "o",
+    )
+
+    def __init__(self):
+        self.ce_avg = None
+        self.pe_avg = None
+        self.ce_sl = None
+        self.pe_sl = None
+        self.target = None
+        self.mtm = 0
+        self.straddle_premium = None
+        self.o = {}
 
 
-## pylint: disable=too-many-instance-attributes
 class ShortStraddle(bt.Strategy):
     """Short Straddle Strategy"""
 
@@ -29,15 +112,8 @@ class ShortStraddle(bt.Strategy):
         super().__init__()
         self.ce_data = self.datas[0]
         self.pe_data = self.datas[1]
-        self.ce_avg = None
-        self.pe_avg = None
-        self.ce_sl = None
-        self.pe_sl = None
-        self.target = None
         self.order = None
-        self.mtm = 0
-        self.straddle_premium = None
-        self.o = {}
+        self.state = _StraddleState()
         self.logger = logging.getLogger(__name__)
 
     ## pylint: disable=no-member
@@ -46,56 +122,55 @@ class ShortStraddle(bt.Strategy):
         if self.order:
             return
 
-        ce_time = self.ce_data.datetime.datetime()
-        pe_time = self.pe_data.datetime.datetime()
-        ## check if both the data feeds are in sync
-        if ce_time != pe_time:
-            self.log("Data feeds are not in sync")
-            self.log(f"CE Time: {ce_time}, PE Time: {pe_time}")
-            return
-
-        current_datetime = ce_time
+        state = self.state
+        ## feeds share the same index, see align_feeds
+        current_datetime = self.ce_data.datetime.datetime()
+        ## Read the closes once, each [0] goes through the line buffer
+        ce_c = self.ce_data.close[0]
+        pe_c = self.pe_data.close[0]
 
         if not self.position:
-            if not self.straddle_premium and current_datetime.time() >= time(10, 00):
-                self.ce_avg = self.ce_data.close[0]
-                self.pe_avg = self.pe_data.close[0]
+            if not state.straddle_premium and current_datetime.time() >= time(10, 00):
+                state.ce_avg = ce_c
+                state.pe_avg = pe_c
 
                 ## If the difference between the put and call options is less than
                 ## 25% of the average of the two, place the straddle
                 if (
-                    abs(self.ce_avg - self.pe_avg) / ((self.ce_avg + self.pe_avg) / 2)
+                    abs(state.ce_avg - state.pe_avg)
+                    / ((state.ce_avg + state.pe_avg) / 2)
                     > self.params.thresh_diff
                 ):
                     self.log(
-                        "Not taking PE :%.2f CE: %.2f" % (self.pe_avg, self.ce_avg)
+                        "Not taking PE :%.2f CE: %.2f" % (state.pe_avg, state.ce_avg)
                     )
                     return
-                self.straddle_premium = self.ce_avg + self.pe_avg
-                self.target = self.straddle_premium * self.params.target_factor
-                self.ce_sl = self.ce_avg * self.params.sl_factor
-                self.pe_sl = self.pe_avg * self.params.sl_factor
+                state.straddle_premium = state.ce_avg + state.pe_avg
+                state.target = state.straddle_premium * self.params.target_factor
+                state.ce_sl = state.ce_avg * self.params.sl_factor
+                state.pe_sl = state.pe_avg * self.params.sl_factor
 
-                self.log(f"Straddle Placed Price: {self.straddle_premium}")
-                self.log(f"CE Avg: {self.ce_avg}")
-                self.log(f"PE Avg: {self.pe_avg}")
-                self.log(f"CE SL: {self.ce_sl}")
-                self.log(f"PE SL: {self.pe_sl}")
+                self.log(f"Straddle Placed Price: {state.straddle_premium}")
+                self.log(f"CE Avg: {state.ce_avg}")
+                self.log(f"PE Avg: {state.pe_avg}")
+                self.log(f"CE SL: {state.ce_sl}")
+                self.log(f"PE SL: {state.pe_sl}")
 
-                self.o["ce"] = self.sell(data=self.ce_data, price=self.ce_avg)
-                self.o["pe"] = self.sell(data=self.pe_data, price=self.pe_avg)
+                state.o["ce"] = self.sell(data=self.ce_data, price=state.ce_avg)
+                state.o["pe"] = self.sell(data=self.pe_data, price=state.pe_avg)
 
-                self.buy(data=self.ce_data, price=self.ce_sl, exectype=bt.Order.Stop)
-                self.buy(data=self.pe_data, price=self.pe_sl, exectype=bt.Order.Stop)
+                self.buy(data=self.ce_data, price=state.ce_sl, exectype=bt.Order.Stop)
+                self.buy(data=self.pe_data, price=state.pe_sl, exectype=bt.Order.Stop)
 
         else:
+            state.mtm = state.straddle_premium - (ce_c + pe_c)
             if current_datetime.time() == self.params.exit_time:
                 self.close(data=self.ce_data)
                 self.close(data=self.pe_data)
                 self.log("Exiting the trade")
 
             ## exit if target is hit premium is decayed by 40%
-            elif self.mtm >= self.target:
+            elif state.mtm >= state.target:
                 self.close(data=self.ce_data)
                 self.close(data=self.pe_data)
                 self.log("Target Hit, Exiting the trade")
@@ -156,7 +231,7 @@ class FixedCommisionScheme(bt.CommInfoBase):
     """Fixed commission scheme"""
 
     params = (
-        ("commission", 10),
+        ("commission", FLAT_FEE),
         ("stocklike", True),
         ("commtype", bt.CommInfoBase.COMM_FIXED),
     )
@@ -190,20 +265,29 @@ class Expectancy(bt.Analyzer):
 
     def get_analysis(self):
         """Returns the expectancy of the strategy"""
-        try:
-            expectancy = (
-                (self.total_gain / self.wins) / (self.total_loss / self.losses)
-                if self.losses > 0
-                else float("inf")
-            )
-            return {"expectancy": expectancy}
-        except:  ## pylint: disable=bare-except
+        if self.losses == 0:
+            return {"expectancy": float("inf")}
+        loss_avg = self.total_loss / self.losses
+        ## No wins or only break even losses
+        if self.wins == 0 or loss_avg == 0:
             return {"expectancy": 0}
-
-
-def main(ce_srike_file: str, pe_srike_file: str, index: str):
-    """Main function to run the backtest"""
-    cerebro = bt.Cerebro()
+        return {"expectancy": (self.total_gain / self.wins) / loss_avg}
+
+
+def run_cerebro(
+    ce_df: pd.DataFrame,
+    pe_df: pd.DataFrame,
+    index: str,
+    fast: bool = False,
+    plot: bool = False,
+):
+    """
+    Run the backtrader version of the strategy, with analyzers
+    fast: only the Expectancy analyzer, no observers, for parameter runs
+    plot: plot the run once done, backtrader imports matplotlib only then
+    """
+    ## stdstats adds the Broker, BuySell and Trades observers
+    cerebro = bt.Cerebro(stdstats=not fast)
     cerebro.addstrategy(
         ShortStraddle,
         sl_factor=1.55,
@@ -212,23 +296,6 @@ def main(ce_srike_file: str, pe_srike_file: str, index: str):
         thresh_diff=0.75,
     )
 
-    pe_df = pd.read_csv(pe_srike_file, parse_dates=True, index_col=0)
-    ce_df = pd.read_csv(ce_srike_file, parse_dates=True, index_col=0)
-
-    ## get the starttime which is same for both the dataframes, the first one
-    start_time = max(pe_df.index[0], ce_df.index[0])
-
-    print(start_time)
-
-    # Filter the DataFrame
-    ce_df = ce_df[ce_df.index >= start_time]
-    pe_df = pe_df[pe_df.index >= start_time]
-
-    pe_df.index = pd.to_datetime(pe_df.index)
-    pe_df = pe_df.resample("1min").ffill()
-    ce_df.index = pd.to_datetime(ce_df.index)
-    ce_df = ce_df.resample("1min").ffill()
-
     ##pylint: disable=unexpected-keyword-arg
     cerebro.adddata(bt.feeds.PandasData(dataname=pe_df), name="pe_data")
     cerebro.adddata(bt.feeds.PandasData(dataname=ce_df), name="ce_data")
@@ -238,19 +305,16 @@ def main(ce_srike_file: str, pe_srike_file: str, index: str):
     cerebro.broker.setcash(100000.0)
     ## Add a flat fee of 10 INR per trade
     cerebro.broker.addcommissioninfo(FixedCommisionScheme)
-    ## Add analyzers
-    cerebro.addanalyzer(bt.analyzers.PyFolio, _name="pyfolio")
-    # Add analyzers
+    ## Add analyzers, Expectancy is all that parameter runs look at
     cerebro.addanalyzer(Expectancy, _name="expectancy")
-    cerebro.addanalyzer(bt.analyzers.SQN, _name="sqn")
-    cerebro.addanalyzer(bt.analyzers.DrawDown, _name="drawdown")
-    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name="trades")
-    ## Add observers
-    cerebro.addobserver(bt.observers.Value)
-    cerebro.addobserver(bt.observers.Trades)
-    cerebro.addobserver(bt.observers.BuySell)
-    cerebro.addobserver(bt.observers.DrawDown)
-    cerebro.addobserver(bt.observers.Broker)
+    if not fast:
+        cerebro.addanalyzer(bt.analyzers.PyFolio, _name="pyfolio")
+        cerebro.addanalyzer(bt.analyzers.SQN, _name="sqn")
+        cerebro.addanalyzer(bt.analyzers.DrawDown, _name="drawdown")
+        cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name="trades")
+        ## Add observers
+        cerebro.addobserver(bt.observers.Value)
+        cerebro.addobserver(bt.observers.DrawDown)
 
     logging.info("Starting Portfolio Value: %.2f", cerebro.broker.getvalue())
 
@@ -260,11 +324,14 @@ def main(ce_srike_file: str, pe_srike_file: str, index: str):
 
     # Get analysis results
     expectancy = results[0].analyzers.expectancy.get_analysis()["expectancy"]
+    logging.info("Expectancy: %.2f", expectancy)
+    if fast:
+        return
+
     sqn = results[0].analyzers.sqn.get_analysis()["sqn"]
     trades = results[0].analyzers.trades.get_analysis()
 
     ## Display the results
-    logging.info("Expectancy: %.2f", expectancy)
     logging.info("SQN: %.2f", sqn)
     ## Display details from the trades its a AutoOrderedDict
     wons = trades["won"]["total"]
@@ -274,13 +341,95 @@ def main(ce_srike_file: str, pe_srike_file: str, index: str):
     logging.info("Trades Lost: %d", lost)
     logging.info("Drawdown: %.2f", drawndown["max"]["drawdown"])
 
-    cerebro.plot(
-        style="candlestick",
-        barup="green",
-        bardown="red",
-        fmt_x_ticks="%H:%M",
-        fmt_x_data="%H:%M",
+    if plot:
+        cerebro.plot(
+            style="candlestick",
+            barup="green",
+            bardown="red",
+            fmt_x_ticks="%H:%M",
+            fmt_x_data="%H:%M",
+        )
+
+
+## pylint: disable=too-many-locals
+def main(
+    ce_srike_file: str,
+    pe_srike_file: str,
+    index: str,
+    cerebro: bool = False,
+    grid_search: bool = False,
+    fast: bool = False,
+    plot: bool = False,
+):
+    """Main function to run the backtest"""
+    ## backtrader needs all of OHLCV, the kernel only the close prices
+    columns = None if cerebro else ["close"]
+    pe_df = read_feed(pe_srike_file, columns)
+    ce_df = read_feed(ce_srike_file, columns)
+
+    ## One minute bars over the period common to both the feeds
+    ce_df, pe_df = align_feeds(ce_df, pe_df)
+    logging.info("Start Time: %s", ce_df.index[0])
+
+    if cerebro:
+        run_cerebro(ce_df, pe_df, index, fast=fast, plot=plot)
+        return
+
+    if AOT_KERNEL:
+        logging.info("Straddle kernel: straddle_ext, ahead of time build")
+    elif straddle_ext is not None:
+        logging.warning("Stale straddle_ext, rerun compile_kernels.py, using JIT")
+    else:
+        logging.info("Straddle kernel: straddle_kernels, JIT")
+
+    times = ce_df.index
+    ce = ce_df["close"].to_numpy(dtype=np.float64)
+    pe = pe_df["close"].to_numpy(dtype=np.float64)
+    minutes = (times.hour * 60 + times.minute).to_numpy(dtype=np.int64)
+
+    ## Entry from 10:00 when the premiums are within 75% of each other
+    entries = entry_mask(ce, pe, minutes, 0.75, 10 * 60)
+
+    if grid_search:
+        sl_factors = np.round(np.arange(1.25, 2.55, 0.05), 2)
+        target_factors = np.round(np.arange(0.2, 0.85, 0.05), 2)
+        pnl = sweep(ce, pe, minutes, entries, sl_factors, target_factors, 15 * 60 + 29)
+        best_sl, best_target = np.unravel_index(np.argmax(pnl), pnl.shape)
+        logging.info(
+            "Best SL Factor: %.2f Target Factor: %.2f PnL: %.2f",
+            sl_factors[best_sl],
+            target_factors[best_target],
+            pnl[best_sl, best_target] * LOT_SIZE[index] - 4 * FLAT_FEE,
+        )
+        return
+
+    entry_idx, exit_idx, mtm = run_straddle(
+        ce,
+        pe,
+        minutes,
+        entries,
+        1.55,  ## sl_factor
+        0.4,  ## target_factor
+        15 * 60 + 29,  ## exit at 15:29
+    )
+    if entry_idx == -1:
+        logging.info("Straddle not placed, premiums never within the threshold")
+        return
+
+    lot_size = LOT_SIZE[index]
+    ## 2 sell and 2 buy orders at flat fee of 10 INR each
+    pnl = mtm[exit_idx] * lot_size - 4 * FLAT_FEE
+    drawdown = np.max(np.maximum.accumulate(mtm) - mtm) * lot_size
+
+    logging.info(
+        "Straddle Placed: %s CE: %.2f PE: %.2f",
+        times[entry_idx],
+        ce[entry_idx],
+        pe[entry_idx],
     )
+    logging.info("Exited: %s", times[exit_idx])
+    logging.info("PnL: %.2f", pnl)
+    logging.info("Max Drawdown: %.2f", drawdown)
 
 
 ## add argument for ce and pe files ATM strike price and index
@@ -320,6 +469,34 @@ def get_args():
         required=True,
         help="The root folder where the data is stored",
     )
+    ## run through backtrader instead of the vectorized kernel
+    parser.add_argument(
+        "--cerebro",
+        action="store_true",
+        default=False,
+        help="Run the backtrader strategy with analyzers",
+    )
+    ## grid search over sl_factor and target_factor
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        default=False,
+        help="Grid search the stop loss and target factors",
+    )
+    ## backtrader without observers and extra analyzers
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        default=False,
+        help="With --cerebro, skip the observers and all analyzers but Expectancy",
+    )
+    ## plotting renders every bar, keep it opt-in
+    parser.add_argument(
+        "--plot",
+        action="store_true",
+        default=False,
+        help="With --cerebro, plot the run once done",
+    )
 
     return parser.parse_args()
 
@@ -339,4 +516,12 @@ if __name__ == "__main__":
 
     logging.info("CE Strike File: %s", ce_srike)
     logging.info("PE Strike File: %s", pe_srike)
-    main(ce_srike, pe_srike, args.index)
+    main(
+        ce_srike,
+        pe_srike,
+        args.index,
+        cerebro=args.cerebro,
+        grid_search=args.sweep,
+        fast=args.fast,
+        plot=args.plot,
+    )
@@ -2,12 +2,70 @@
 Shoonaya API Client with login caching
 """
 import datetime
+import functools
 import logging
 
+import NorenRestApiPy.NorenApi
 import pyotp
 import redis
+import requests
 import yaml
 from NorenRestApiPy.NorenApi import NorenApi
+from requests.adapters import HTTPAdapter
+
+## libyaml C parser when PyYAML is built with it, pure python otherwise
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+class _PooledRequests:
+    """
+    Stands in for the requests module inside NorenRestApiPy.NorenApi,
+    post goes through a pooled session, everything else is requests itself
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def post(self, *args, **kwargs):
+        return self.session.post(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+## NorenApi posts every call with a bare requests.post, a new TCP and TLS
+## handshake per order or quote, and has no hook to pass a session. Its
+## requests is replaced once with the shim above, this is process wide:
+## every NorenApi of the process shares the session. Only connection
+## failures are retried, a POST that reached the broker is never resent
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=2, pool_maxsize=8, max_retries=3)
+)
+NorenRestApiPy.NorenApi.requests = _PooledRequests(_HTTP_SESSION)
+
+## Shared by every client of the process, values come back as str
+_REDIS_POOL = redis.ConnectionPool(max_connections=4, decode_responses=True)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_credentials(cred_file):
+    """
+    Load the credentials file, parsed only once per file
+    """
+    with open(cred_file, encoding="utf-8") as f:
+        return yaml.load(f, Loader=YamlLoader)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_totp(totp_pin):
+    """
+    TOTP generator for the pin, built once per pin
+    """
+    return pyotp.TOTP(totp_pin)
 
 
 class ShoonyaApiPy(NorenApi):
@@ -17,7 +75,7 @@ class ShoonyaApiPy(NorenApi):
 
     def __init__(self, cred_file="cred.yml", force_login=False):
         self.logger = logging.getLogger(__name__)
-        self.redis_client = redis.Redis()
+        self.redis_client = redis.Redis(connection_pool=_REDIS_POOL)
         self.cred_file = cred_file
         self.access_token_key = "access_token_shoonya"
         self.last_login_date_key = "last_login_date_shoonya"
@@ -33,14 +91,14 @@ class ShoonyaApiPy(NorenApi):
         """
         Load and return credentials from file
         """
-        with open(self.cred_file, encoding="utf-8") as f:
-            return yaml.load(f, Loader=yaml.FullLoader)
+        return _load_credentials(self.cred_file)
 
     def _login(self, force=False):
         """
         Login to the Shoonya API. If force is True, force a new login.
         If force is False, use cached access token if available and not expired.
         """
+        cred = self._get_credentials()
         try:
             access_token = self.redis_client.get(self.access_token_key)
             last_login_date = self.redis_client.get(self.last_login_date_key)
@@ -50,10 +108,8 @@ class ShoonyaApiPy(NorenApi):
                 access_token
                 and not force
                 and last_login_date
-                and last_login_date.decode("utf-8") == today
+                and last_login_date == today
             ):
-                access_token = access_token.decode("utf-8")
-                cred = self._get_credentials()
                 self.set_session(cred["user"], cred["pwd"], access_token)
                 self.logger.debug("Access token found in cache, logging in")
             else:
@@ -64,12 +120,10 @@ class ShoonyaApiPy(NorenApi):
             self.logger.debug(
                 "No access token found in cache or token expired, logging in: %s", ex
             )
-            cred = self._get_credentials()
-
             ret = self.login(
                 userid=cred["user"],
                 password=cred["pwd"],
-                twoFA=pyotp.TOTP(cred["totp_pin"]).now(),
+                twoFA=_get_totp(cred["totp_pin"]).now(),
                 vendor_code=cred["vc"],
                 api_secret=cred["apikey"],
                 imei=cred["imei"],
@@ -0,0 +1,25 @@
+"""
+Ahead of time build of the straddle kernel into the straddle_ext module,
+backtest.py picks it up when built from the current straddle_kernels.py
+and skips the JIT compilation
+usage: python compile_kernels.py
+"""
+
+from numba.pycc import CC
+
+from straddle_kernels import KERNELS_DIGEST
+from straddle_kernels import RUN_STRADDLE_SIGNATURE
+from straddle_kernels import run_straddle
+
+cc = CC("straddle_ext")
+cc.export("run_straddle", RUN_STRADDLE_SIGNATURE)(run_straddle.py_func)
+
+
+@cc.export("kernels_digest", "int64()")
+def kernels_digest():
+    """Digest of the straddle_kernels.py this module was built from"""
+    return KERNELS_DIGEST
+
+
+if __name__ == "__main__":
+    cc.compile()
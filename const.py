@@ -2,87 +2,54 @@
 Constants for shoonya trading
 """
 import enum
+from collections import namedtuple
 
 
-INDICES_TOKEN = {
-    "NIFTY": "26000",
-    "BANKNIFTY": "26009",
-    "FINNIFTY": "26037",
-    "INDIAVIX": "26017",
-    "MIDCPNIFTY": "26074",
-    "SENSEX": "1",
-    "USDINR": "1",
-    "EURINR": "25",
-    "GBPINR": "26",
-    "JPYINR": "27",
-    "BANKEX": "12",
-    "CRUDEOIL": "426261",
+## Static details of an instrument, all fetched with a single lookup
+InstrumentSpec = namedtuple(
+    "InstrumentSpec", ["token", "rounding", "lot_size", "exchange", "scrip"]
+)
+
+INSTRUMENTS = {
+    "NIFTY": InstrumentSpec("26000", 50, 50, "NFO", "NIFTY"),
+    "BANKNIFTY": InstrumentSpec("26009", 100, 15, "NFO", "BANKNIFTY"),
+    "FINNIFTY": InstrumentSpec("26037", 50, 25, "NFO", "FINNIFTY"),
+    "INDIAVIX": InstrumentSpec("26017", None, None, "NFO", "INDIAVIX"),
+    "MIDCPNIFTY": InstrumentSpec("26074", 25, 75, "NFO", "MIDCPNIFTY"),
+    "SENSEX": InstrumentSpec("1", 100, 10, "BFO", "BSXOPT"),
+    "USDINR": InstrumentSpec("1", 0.25, 1000, "CDS", "USDINR"),
+    "EURINR": InstrumentSpec("25", 0.25, 1000, "CDS", "EURINR"),
+    "GBPINR": InstrumentSpec("26", 0.25, 1000, "CDS", "GBPINR"),
+    "JPYINR": InstrumentSpec("27", 0.25, 1000, "CDS", "JPYINR"),
+    "BANKEX": InstrumentSpec("12", 100, 15, "BFO", "BKXOPT"),
+    "CRUDEOIL": InstrumentSpec("426261", 50, 100, "MCX", "CRUDEOIL"),
 }
 
+## Per field views of INSTRUMENTS
+INDICES_TOKEN = {name: spec.token for name, spec in INSTRUMENTS.items()}
+
 INDICES_ROUNDING = {
-    "NIFTY": 50,
-    "BANKNIFTY": 100,
-    "FINNIFTY": 50,
-    "MIDCPNIFTY": 25,
-    "SENSEX": 100,
-    "USDINR": 0.25,
-    "EURINR": 0.25,
-    "GBPINR": 0.25,
-    "JPYINR": 0.25,
-    "BANKEX": 100,
-    "CRUDEOIL": 50,
+    name: spec.rounding
+    for name, spec in INSTRUMENTS.items()
+    if spec.rounding is not None
 }
 
 LOT_SIZE = {
-    "NIFTY": 50,
-    "BANKNIFTY": 15,
-    "FINNIFTY": 25,
-    "SENSEX": 10,
-    "BANKEX": 15,
-    "MIDCPNIFTY": 75,
-    "USDINR": 1000,
-    "EURINR": 1000,
-    "GBPINR": 1000,
-    "JPYINR": 1000,
-    "CRUDEOIL": 100,
+    name: spec.lot_size
+    for name, spec in INSTRUMENTS.items()
+    if spec.lot_size is not None
 }
 
-EXCHANGE = {
-    "NIFTY": "NFO",
-    "BANKNIFTY": "NFO",
-    "FINNIFTY": "NFO",
-    "SENSEX": "BFO",
-    "BANKEX": "BFO",
-    "MIDCPNIFTY": "NFO",
-    "INDIAVIX": "NFO",
-    "USDINR": "CDS",
-    "EURINR": "CDS",
-    "GBPINR": "CDS",
-    "JPYINR": "CDS",
-    "CRUDEOIL": "MCX",
-}
+EXCHANGE = {name: spec.exchange for name, spec in INSTRUMENTS.items()}
 
-
-SCRIP_SYMBOL_NAME = {
-    "NIFTY": "NIFTY",
-    "BANKNIFTY": "BANKNIFTY",
-    "FINNIFTY": "FINNIFTY",
-    "SENSEX": "BSXOPT",
-    "BANKEX": "BKXOPT",
-    "MIDCPNIFTY": "MIDCPNIFTY",
-    "INDIAVIX": "INDIAVIX",
-    "USDINR": "USDINR",
-    "EURINR": "EURINR",
-    "GBPINR": "GBPINR",
-    "JPYINR": "JPYINR",
-    "CRUDEOIL": "CRUDEOIL",
-}
+SCRIP_SYMBOL_NAME = {name: spec.scrip for name, spec in INSTRUMENTS.items()}
 
 
 ## Enum for order status
-class OrderStatus(enum.Enum):
+class OrderStatus(str, enum.Enum):
     """
-    Enum for order status
+    Enum for order status, members are plain strings too
+    and compare equal to the status strings of the broker
     """
 
     OPEN = "OPEN"
@@ -93,6 +60,5 @@ class OrderStatus(enum.Enum):
     PENDING = "PENDING"
     INVALID_STATUS_TYPE = "INVALID_STATUS_TYPE"
 
-    ## tostring method
-    def __str__(self):
-        return self.value
+    ## tostring is the value itself, using str's own slot
+    __str__ = str.__str__
@@ -1,8 +1,29 @@
 """Module to handle data storage in Redis"""
 import logging
+import struct
 
 import redis
 
+## Floats are stored as a tag byte followed by a little-endian double,
+## the tag is never valid utf-8, telling them apart from string values.
+## Ints keep redis' decimal string form, exact at any size
+_FLOAT_TAG = b"\xff"
+_FLOAT_STRUCT = struct.Struct("<d")
+
+
+def _pack(value):
+    """Pack floats as tagged doubles, other values are stored as is"""
+    if isinstance(value, float):
+        return _FLOAT_TAG + _FLOAT_STRUCT.pack(value)
+    return value
+
+
+def _unpack(value):
+    """Unpack a tagged double, falling back to decoding a string value"""
+    if len(value) == _FLOAT_STRUCT.size + 1 and value[:1] == _FLOAT_TAG:
+        return _FLOAT_STRUCT.unpack_from(value, 1)[0]
+    return value.decode("utf-8")
+
 
 class DataStore:
     """Class to handle data storage in Redis"""
@@ -23,7 +44,9 @@ class DataStore:
         self.instance_id = instance_id
         self.logger = logger if logger else logging.getLogger(__name__)
         try:
-            self.r = redis.Redis()
+            ## callers beyond the cap wait for a free connection, not fail
+            self.pool = redis.BlockingConnectionPool(max_connections=16, timeout=5)
+            self.r = redis.Redis(connection_pool=self.pool)
             self.r.ping()  # Test the connection
         except redis.ConnectionError as e:
             self.logger.error("Failed to connect to Redis: %s", e)
@@ -42,6 +65,7 @@ class DataStore:
         try:
             if self.r:
                 self.r.close()
+                self.pool.disconnect()
         except redis.RedisError as e:
             self.logger.error("Failed to close Redis connection: %s", e)
 
@@ -63,7 +87,7 @@ class DataStore:
         :param value: Value to associate with the key.
         """
         try:
-            self.r.set(self._get_cache_key(key, instance_id), value)
+            self.r.set(self._get_cache_key(key, instance_id), _pack(value))
         except redis.RedisError as e:
             self.logger.error("Failed to set key %s in Redis: %s", key, e)
             raise
@@ -80,12 +104,24 @@ class DataStore:
             value = self.r.get(self._get_cache_key(key, instance_id))
             if value is None:
                 return None
-            value = value.decode("utf-8")  # Decode the byte value to string
-            return cast_to(value)
+            return cast_to(_unpack(value))
         except (redis.RedisError, ValueError) as e:
             self.logger.error("Failed to get or cast key %s in Redis: %s", key, e)
             raise
 
+    def exists(self, key, instance_id=None):
+        """
+        Check if a key exists in Redis, without transferring its value.
+
+        :param key: Key to check.
+        :return: True if the key exists.
+        """
+        try:
+            return bool(self.r.exists(self._get_cache_key(key, instance_id)))
+        except redis.RedisError as e:
+            self.logger.error("Failed to check key %s in Redis: %s", key, e)
+            raise
+
     def get_keys(self, instance_id=None):
         """
         Get all keys stored in Redis.
@@ -93,7 +129,7 @@ class DataStore:
         :return: List of keys stored in Redis.
         """
         try:
-            keys = self.r.keys(f"{instance_id}*")
+            keys = self.r.scan_iter(match=f"{instance_id}*", count=500)
             return [key.decode("utf-8") for key in keys]
         except redis.RedisError as e:
             self.logger.error("Failed to get keys in Redis: %s", e)
@@ -0,0 +1,99 @@
+"""
+Numba kernels for the short straddle backtest, kept free of backtrader
+and pandas so that compile_kernels.py can build them ahead of time
+"""
+
+import hashlib
+
+import numpy as np
+from numba import njit
+from numba import prange
+
+## Digest of this file, compiled into straddle_ext so that backtest.py can
+## tell a build of the current kernels from a stale one. Fits an int64
+with open(__file__, "rb") as _source:
+    KERNELS_DIGEST = int(hashlib.sha256(_source.read()).hexdigest()[:15], 16)
+
+## Signature of run_straddle, used for the ahead of time build
+RUN_STRADDLE_SIGNATURE = (
+    "Tuple((int64, int64, float64[:]))"
+    "(float64[:], float64[:], int64[:], boolean[:], float64, float64, int64)"
+)
+
+
+## pylint: disable=too-many-arguments, too-many-locals, too-many-branches
+@njit(cache=True, fastmath=True)
+def run_straddle(ce, pe, minutes, entries, sl_factor, target_factor, exit_min):
+    """
+    Simulate the short straddle over one session in a single pass
+    ce, pe: aligned close prices of the CE and PE legs
+    minutes: minute of the day for each bar
+    entries: bars where the straddle can be placed, see entry_mask
+    Returns the entry index, exit index and the per unit MTM at each bar,
+    entry index is -1 if the straddle was never placed
+    """
+    n = ce.shape[0]
+    mtm = np.zeros(n)
+    entry_idx = -1
+    exit_idx = -1
+    ce_sl = 0.0
+    pe_sl = 0.0
+    target = 0.0
+    premium = 0.0
+    ce_open = False
+    pe_open = False
+    for i in range(n):
+        if entry_idx == -1:
+            if not entries[i]:
+                continue
+            entry_idx = i
+            ce_sl = ce[i] * sl_factor
+            pe_sl = pe[i] * sl_factor
+            premium = ce[i] + pe[i]
+            target = premium * target_factor
+            ce_open = True
+            pe_open = True
+            continue
+
+        ## Stop loss on individual legs, filled at the stop price.
+        ## Evaluated with boolean arithmetic, keeping the loop free of
+        ## unpredictable branches until the exit
+        ce_hit = ce_open & (ce[i] >= ce_sl)
+        pe_hit = pe_open & (pe[i] >= pe_sl)
+        ## The buy back cost of a stopped leg comes out of the collected premium
+        premium -= ce_hit * ce_sl + pe_hit * pe_sl
+        ce_open ^= ce_hit
+        pe_open ^= pe_hit
+
+        ## Same as premium at entry - (ce[i] + pe[i]) while both legs are open
+        mtm[i] = premium - (ce_open * ce[i] + pe_open * pe[i])
+
+        triggered = (
+            (minutes[i] >= exit_min) + (mtm[i] >= target) + (not (ce_open | pe_open))
+        )
+        if triggered > 0:
+            exit_idx = i
+            break
+
+    if entry_idx != -1:
+        if exit_idx == -1:  ## Still open when the data ends
+            exit_idx = n - 1
+        mtm[exit_idx + 1 :] = mtm[exit_idx]
+    return entry_idx, exit_idx, mtm
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def sweep(ce, pe, minutes, entries, sl_factors, target_factors, exit_min):
+    """
+    Per unit PnL of the straddle for every (sl_factor, target_factor) pair,
+    the stop loss factors are spread across the cores
+    """
+    pnl = np.zeros((sl_factors.shape[0], target_factors.shape[0]))
+    for i in prange(sl_factors.shape[0]):  ## pylint: disable=not-an-iterable
+        for j in range(target_factors.shape[0]):
+            entry_idx, exit_idx, mtm = run_straddle(
+                ce, pe, minutes, entries, sl_factors[i], target_factors[j], exit_min
+            )
+            if entry_idx != -1:
+                pnl[i, j] = mtm[exit_idx]
+    return pnl
@@ -26,14 +26,22 @@ from flask.cli import load_dotenv
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import JWTManager
+from pnl import MATCHING_PNL_QUERY
+from pnl import summarize_pnl
 from psycopg2.pool import PoolError
 from psycopg2.pool import ThreadedConnectionPool
 from werkzeug.security import check_password_hash
 from werkzeug.security import generate_password_hash
 
+## libyaml C parser when PyYAML is built with it, pure python otherwise
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 # Read YAML file
 with open("cred.yml", "r", encoding="utf-8") as yml_file:
-    yml_config = yaml.safe_load(yml_file)
+    yml_config = yaml.load(yml_file, Loader=YamlLoader)
 
 app = Flask(__name__)
 app.config["JWT_SECRET_KEY"] = f"shoonya_bot_{yml_config['apikey']}"
@@ -143,56 +151,20 @@ class BotServer:
 
     def _get_pnl(self, instance_id) -> Tuple[float, Dict]:
         """
-        Get PnL for all orders, use all three tables,
-            liveltp has live prices and symbolcode,
-            transactions has avgprice, qty, buysell, tradingsymbol. It does not have symbolcode
-            symbols has symbolcode, exchange, tradingsymbol
-        Note: symbolcode is not tradingsymbol
+        Get PnL for all orders of an instance, see pnl.PNL_QUERY
         """
         rows = []
         try:
             with self._getcursor() as cursor:
                 cursor.execute(
-                    """SELECT transactions.avgprice, transactions.qty, transactions.buysell, 
-                        transactions.tradingsymbol, liveltp.ltp
-                        FROM transactions
-                        JOIN symbols ON transactions.instance = symbols.instance 
-                                        AND transactions.tradingsymbol = symbols.tradingsymbol
-                        JOIN liveltp ON symbols.symbolcode = liveltp.symbolcode
-                        WHERE transactions.instance LIKE %s""",
+                    MATCHING_PNL_QUERY,
                     ("%" + instance_id + "%",),
                 )
                 rows = cursor.fetchall()
         except Exception as e:  ## pylint: disable=broad-exception-caught
             self.logger.error("Failed to execute SQL query %s", e)
             return -999.999
-        total_pnl = 0
-        msg = {}
-        for row in rows:
-            avgprice = round(float(row.avgprice), 2)
-            qty = int(row.qty)
-            buysell = row.buysell
-            tradingsymbol = row.tradingsymbol
-            ltp = round(float(row.ltp), 2)
-            if avgprice == -1 or qty == -1:
-                continue
-            if buysell == "B":
-                pnl = (ltp - avgprice) * qty
-            else:
-                pnl = (avgprice - ltp) * qty
-            total_pnl += pnl
-            msg[tradingsymbol] = {
-                "buysell": buysell,
-                "qty": int(qty),
-                "avgprice": avgprice,
-                "ltp": ltp,
-                "pnl": round(pnl, 2),
-            }
-        if msg:
-            ## sort msg by key
-            msg = dict(sorted(msg.items()))
-            msg["Total"] = round(total_pnl, 2)
-        return total_pnl, msg
+        return summarize_pnl(rows)
 
     def get_pnl(self):
         """Get PnL for all instances"""
@@ -325,6 +297,10 @@ class BotServer:
     def modify_target(self, target, instance_id):
         """Modify target for an instance"""
         try:
+            ## Exact instance id, no need to scan the keys
+            if self.redis_store.exists("target_mtm", instance_id):
+                self.redis_store.set_param("target_mtm", target, instance_id)
+                return True
             ## Find the key which has the instance_id
             ## get all keys from redis
             keys = self.redis_store.get_keys(instance_id)
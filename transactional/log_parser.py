@@ -64,10 +64,7 @@ def main(file_names: list):
             last_pnl = df.iloc[-1]["PnL"]
             summary.append((sheet_name, last_pnl))
 
-            if date_str not in day_wise_pnl:
-                day_wise_pnl[date_str] = last_pnl
-            else:
-                day_wise_pnl[date_str] += last_pnl
+            day_wise_pnl[date_str] = day_wise_pnl.get(date_str, 0) + last_pnl
 
             pbar.set_description(f"Writing {sheet_name:20s}")
 
@@ -4,6 +4,7 @@ Order manager
 
 import datetime
 import logging
+import threading
 import time
 from typing import Any
 from typing import Dict
@@ -11,6 +12,9 @@ from typing import Dict
 from utils import wait_with_progress
 from utils import full_stack
 
+## Indian Standard Time, UTC+05:30
+IST = datetime.timezone(datetime.timedelta(hours=5, minutes=30))
+
 
 class OrderManager:
     """
@@ -24,9 +28,26 @@ class OrderManager:
         self.logger = logging.getLogger(__name__)
         self.api = api_object
         self.opened = False
+        ## set from the websocket thread once opened
+        self._opened_evt = threading.Event()
+        ## set from a websocket callback that failed, see shutting_down
+        self._shutdown_evt = threading.Event()
         self.subscribed_symbols = set()
         self.running = False
         self.config = config
+        self._set_day_over_cutoff()
+
+    def _set_day_over_cutoff(self):
+        """
+        The day over window, 15:31 to 16:00 IST, and the following midnight
+        of today as unix timestamps
+        """
+        today = datetime.datetime.now(IST).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        self._day_over_ts = today.replace(hour=15, minute=31).timestamp()
+        self._day_over_end_ts = today.replace(hour=16).timestamp()
+        self._day_end_ts = (today + datetime.timedelta(days=1)).timestamp()
 
     def _event_handler_feed_update(self, tick_data: Dict):
         """
@@ -42,12 +63,27 @@ class OrderManager:
             self.logger.info("Websocket Re-Opened")
             ## check if self.subscribed_symbols is non empty, if yes resubscribe
             if self.subscribed_symbols:
-                self.logger.info("Resubscribing to %s", self.subscribed_symbols)
-                ## convert to list
-                self.api.subscribe(list(self.subscribed_symbols))
+                ## snapshot as a list, the api expects one and the set may
+                ## change from another thread while logging
+                symbols = list(self.subscribed_symbols)
+                self.logger.info("Resubscribing to %s", symbols)
+                self.api.subscribe(symbols)
         else:
             self.logger.info("Websocket Opened")
         self.opened = True
+        self._opened_evt.set()
+
+    def _error_callback(self, e):
+        """
+        Callback for websocket error
+        """
+        self.logger.error("Websocket Error: %s\n%s", e, full_stack())
+
+    def _close_callback(self):
+        """
+        Callback for websocket close
+        """
+        self.logger.info("Websocket Closed")
 
     def _event_handler_order_update(self, order_data):
         """
@@ -91,11 +127,18 @@ class OrderManager:
         """
         Day over
         """
-        ## Add 5 hours 30 minutes to UTC time for IST
-        now = datetime.datetime.utcnow() + datetime.timedelta(hours=5, minutes=30)
-        if now.hour == 15 and now.minute >= 31:
-            return True
-        return False
+        ## Compare against the precomputed 15:31 to 15:59 IST window, no
+        ## datetime per call. Only that window, MCX and CDS trade later
+        now = time.time()
+        if now >= self._day_end_ts:  ## past midnight, a new trading day
+            self._set_day_over_cutoff()
+        return self._day_over_ts <= now < self._day_over_end_ts
+
+    def shutting_down(self):
+        """
+        A websocket callback failed and the bot should stop
+        """
+        return self._shutdown_evt.is_set()
 
     def start(self):
         """
@@ -110,22 +153,14 @@ class OrderManager:
                     order_update_callback=self._event_handler_order_update,
                     subscribe_callback=self._event_handler_feed_update,
                     socket_open_callback=self._open_callback,
-                    socket_error_callback=lambda e: self.logger.error(
-                        "Websocket Error: %s\n%s", e, full_stack()
-                    ),
-                    socket_close_callback=lambda: self.logger.info("Websocket Closed"),
+                    socket_error_callback=self._error_callback,
+                    socket_close_callback=self._close_callback,
                 )
 
-            open_start_time = time.time()
-            while self.opened is False:
-                elapsed_time = time.time() - open_start_time
-                if elapsed_time > 30:  # If WebSocket is not open after 30 seconds
-                    self.logger.warning(
-                        "WebSocket not open after 30 seconds. Retrying..."
-                    )
-                    break
-                self.logger.warning("Waiting for websocket to open")
-                time.sleep(0.5)
+            self.logger.warning("Waiting for websocket to open")
+            ## If WebSocket is not open after 30 seconds
+            if not self._opened_evt.wait(timeout=30):
+                self.logger.warning("WebSocket not open after 30 seconds. Retrying...")
 
             if self.opened:
                 self.running = True
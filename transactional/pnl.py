@@ -0,0 +1,53 @@
+"""PnL of the orders of an instance, shared by the bot and the bot server"""
+
+from typing import Dict
+from typing import Tuple
+
+## Per leg PnL using all three tables,
+##   liveltp has live prices and symbolcode,
+##   transactions has avgprice, qty, buysell, tradingsymbol. It does not have symbolcode
+##   symbols has symbolcode, exchange, tradingsymbol
+## Unfilled orders are filtered out and the quantity is signed by buysell.
+## instance_match is the operator matching transactions.instance, = or LIKE
+PNL_QUERY = """SELECT transactions.qty, transactions.buysell,
+        transactions.tradingsymbol, prices.avgprice, prices.ltp,
+        (prices.ltp - prices.avgprice) * CASE
+            WHEN transactions.buysell = 'B'
+            THEN transactions.qty ELSE -transactions.qty
+        END AS pnl
+FROM transactions
+JOIN symbols ON transactions.instance = symbols.instance
+                AND transactions.tradingsymbol = symbols.tradingsymbol
+JOIN liveltp ON symbols.symbolcode = liveltp.symbolcode
+CROSS JOIN LATERAL (SELECT
+    ROUND(transactions.avgprice::numeric, 2)::float8 AS avgprice,
+    ROUND(liveltp.ltp::numeric, 2)::float8 AS ltp) AS prices
+WHERE transactions.instance {instance_match} %s
+AND transactions.avgprice <> -1 AND transactions.qty <> -1
+ORDER BY transactions.tradingsymbol"""
+## Formatted once at import, the queries run on every PnL check
+## PnL of one instance, by its exact id
+INSTANCE_PNL_QUERY = PNL_QUERY.format(instance_match="=")
+## PnL of the instances whose id matches a LIKE pattern
+MATCHING_PNL_QUERY = PNL_QUERY.format(instance_match="LIKE")
+
+
+def summarize_pnl(rows) -> Tuple[float, Dict]:
+    """
+    Total PnL and the per leg display message for the rows of PNL_QUERY
+    """
+    total_pnl = 0
+    msg = {}
+    for row in rows:
+        total_pnl += row.pnl
+        msg[row.tradingsymbol] = {
+            "buysell": row.buysell,
+            "qty": row.qty,
+            "avgprice": row.avgprice,
+            "ltp": row.ltp,
+            "pnl": round(row.pnl, 2),
+        }
+    if msg:
+        ## rows come sorted by tradingsymbol, the total goes last
+        msg["Total"] = round(total_pnl, 2)
+    return total_pnl, msg
@@ -3,10 +3,11 @@ This module is used to place orders for straddle strategy using Shoonya API.
 Uses relational database to store orders and their status.
 """
 
-import json
 import logging
 import sys
 import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 
 import transaction_manager_postgres  ## pylint: disable=import-error
@@ -14,6 +15,7 @@ import transaction_manager_postgres  ## pylint: disable=import-error
 from client_shoonya import ShoonyaApiPy
 from const import OrderStatus
 from data_store import DataStore  ## pylint: disable=import-error
+from utils import LazyJson
 from utils import configure_logger
 from utils import delay_decorator
 from utils import get_exchange
@@ -25,6 +27,38 @@ from utils import round_to_point5
 from utils import validate
 from utils import wait_with_progress
 
+## Concurrent broker calls while squaring off
+SQUARE_OFF_WORKERS = 4
+## Longest wait between passes of the main loop without an order update,
+## the throttled checks like cancel_on_profit still run on time
+MAIN_LOOP_WAIT = 1.0
+## Values of one leg of the straddle, fixed once the strikes are chosen
+StraddleLeg = namedtuple(
+    "StraddleLeg",
+    [
+        "remarks",
+        "sl_remarks",
+        "order",
+        "symbol_data",
+        "sl_order",
+        "sl_symbol_data",
+    ],
+)
+## Market exit order fields common to every leg
+SQUARE_OFF_ORDER = {
+    "discloseqty": 0,
+    "price_type": "MKT",
+    "price": 0,
+    "trigger_price": None,
+    "retention": "DAY",
+}
+## Side of the order closing a position
+OPPOSITE_SIDE = {"B": "S", "S": "B"}
+## Orders still at the exchange, cancelled on square off
+PENDING_STATUSES = frozenset(
+    [OrderStatus.OPEN, OrderStatus.TRIGGER_PENDING, OrderStatus.PENDING]
+)
+
 
 class ShoonyaTransaction:
     """
@@ -50,9 +84,13 @@ class ShoonyaTransaction:
             },
         )
         self.logger = logging.getLogger(__name__)
+        ## remarks of the ce and pe straddle orders, the prefix of all the others
+        self._straddle_remarks = tuple(
+            get_remarks(instance_id=self.instance_id, msg=f"{item}_straddle")
+            for item in ["ce", "pe"]
+        )
         self.order_queue = set()
-        for item in ["ce", "pe"]:
-            message = get_remarks(instance_id=self.instance_id, msg=f"{item}_straddle")
+        for message in self._straddle_remarks:
             self.order_queue.add(message)
             self.order_queue.add(f"{message}_stop_loss")
             self.order_queue.add(f"{message}_subscribe")
@@ -90,8 +128,7 @@ class ShoonyaTransaction:
             self.logger.info("Order placed: %s", response)
             ## remove remarks from order queue
             self.order_queue.remove(remarks)
-            if exit_order in self.order_queue:
-                self.order_queue.remove(exit_order)
+            self.order_queue.discard(exit_order)
 
     def subscribe(
         self,
@@ -139,12 +176,14 @@ class ShoonyaTransaction:
 
     def over(self):
         """
-        Check if the day is over or order queue is empty
+        Check if the day is over, order queue is empty
+        or a websocket callback failed
         """
         return (
             not self.order_queue
             or self.transaction_manager.day_over()
             or self._both_legs_rejected()
+            or self.transaction_manager.shutting_down()
         )
 
     def cancel_on_book_profit(
@@ -180,26 +219,29 @@ class ShoonyaTransaction:
                     self.order_queue.remove(remarks)
 
     @delay_decorator(delay=10)
-    def cancel_on_profit(self, target_profit: float, target_loss: float):
-        """Cancel order using Shoonya API"""
+    def cancel_on_profit(self, redis_store: DataStore, target_loss: float):
+        """
+        Cancel order using Shoonya API, the target is read from the data store
+        only when the check runs, it can be modified from the bot server
+        """
+        target_profit = redis_store.retrieve_param("target_mtm")
         total_pnl, display_msg = self.transaction_manager.get_pnl()
         if (total_pnl > target_profit) or (total_pnl <= target_loss):
             self.logger.info(
                 "Target reached Current Pnl: %.2f | Target: %.2f | Target Loss: %.2f | Cancelling all pending orders",
                 total_pnl,
                 target_profit,
-                traget_loss,
+                target_loss,
             )
             self._square_off()
         display_msg["Target"] = round(target_profit, 2)
-        self.logger.info(json.dumps(display_msg, indent=2))
+        self.logger.info("%s", LazyJson(display_msg))
 
     @delay_decorator(delay=10)
     def exit_on_book_profit(self):
         """Exit if book profit is reached on each leg"""
         result = True
-        for item in ["ce", "pe"]:
-            message = get_remarks(instance_id=self.instance_id, msg=f"{item}_straddle")
+        for message in self._straddle_remarks:
             book_profit_remarks = f"{message}_book_profit"
             if book_profit_remarks in self.order_queue:
                 ## Not yet placed, still in order queue
@@ -215,6 +257,10 @@ class ShoonyaTransaction:
             self.logger.warning("Book profit reached, sqauring off all pending orders")
             self._square_off()
 
+    def wait_for_update(self, timeout: float = MAIN_LOOP_WAIT):
+        """Wait for an order update instead of spinning the main loop"""
+        return self.transaction_manager.wait_for_order_update(timeout)
+
     def test(self, status: str, interval: int = 15):
         """Test function"""
         return self.transaction_manager.test(status, interval)
@@ -231,8 +277,7 @@ class ShoonyaTransaction:
     def _both_legs_rejected(self):
         """Close the transaction if any leg is rejected"""
         result = True
-        for item in ["ce", "pe"]:
-            message = get_remarks(instance_id=self.instance_id, msg=f"{item}_straddle")
+        for message in self._straddle_remarks:
             norenordno, _ = self.transaction_manager.get_for_remarks(
                 message, OrderStatus.REJECTED
             )
@@ -246,39 +291,39 @@ class ShoonyaTransaction:
     def _square_off(self):
         """Square off all positions"""
         order_book = self.transaction_manager.get_orders()
-        for order in order_book:
-            order_status = order["status"]
-            remarks = order["remarks"]
-            if order_status in [
-                OrderStatus.OPEN,
-                OrderStatus.TRIGGER_PENDING,
-                OrderStatus.PENDING,
-            ]:
-                self.api.cancel_order(order["norenordno"])
-                self.logger.info("Order cancelled: %s", remarks)
-            elif order_status == OrderStatus.COMPLETE:
-                self.logger.info("Placing square off orders: %s", remarks)
-                tradingsymbol = order["tradingsymbol"]
-                qty = order["qty"]
-                exchange = get_exchange(tradingsymbol)
-                opposite_buysell = "B" if order["buysell"] == "S" else "S"
-                ## Place exit order at Market price
-                response = self.api.place_order(
-                    buy_or_sell=opposite_buysell,
-                    product_type=self.product_type,
-                    exchange=exchange,
-                    tradingsymbol=tradingsymbol,
-                    quantity=qty,
-                    discloseqty=0,
-                    price_type="MKT",
-                    price=0,
-                    trigger_price=None,
-                    retention="DAY",
-                    remarks=f"{remarks}_square_off",
-                )
-                self.logger.debug("Square off Order placed: %s", response)
-            else:
-                self.logger.debug("Ignoring Order status: %s", order["status"])
+        ## cancel and exit orders are independent, send them concurrently
+        cancels = {}
+        square_offs = []
+        with ThreadPoolExecutor(max_workers=SQUARE_OFF_WORKERS) as executor:
+            for order in order_book:
+                order_status = order["status"]
+                remarks = order["remarks"]
+                if order_status in PENDING_STATUSES:
+                    future = executor.submit(self.api.cancel_order, order["norenordno"])
+                    cancels[future] = remarks
+                elif order_status == OrderStatus.COMPLETE:
+                    self.logger.info("Placing square off orders: %s", remarks)
+                    tradingsymbol = order["tradingsymbol"]
+                    ## Place exit order at Market price
+                    square_offs.append(
+                        executor.submit(
+                            self.api.place_order,
+                            **SQUARE_OFF_ORDER,
+                            buy_or_sell=OPPOSITE_SIDE[order["buysell"]],
+                            product_type=self.product_type,
+                            exchange=get_exchange(tradingsymbol),
+                            tradingsymbol=tradingsymbol,
+                            quantity=order["qty"],
+                            remarks=f"{remarks}_square_off",
+                        )
+                    )
+                else:
+                    self.logger.debug("Ignoring Order status: %s", order["status"])
+        for future, remarks in cancels.items():
+            future.result()
+            self.logger.info("Order cancelled: %s", remarks)
+        for future in square_offs:
+            self.logger.debug("Square off Order placed: %s", future.result())
         ## Empty the order queue
         self.order_queue.clear()
         ## Wait for 5 seconds
@@ -331,7 +376,7 @@ class ShoonyaTransaction:
                 response = self.api.modify_order(**order_data)
                 self.logger.info("Book Profit Order modified: %s", response)
                 self.logger.debug(
-                    "Book Profit Order modified: %s", json.dumps(order_data, indent=2)
+                    "Book Profit Order modified: %s", LazyJson(order_data)
                 )
                 msg = "Order modified"
             self.logger.debug(
@@ -410,9 +455,7 @@ class ShoonyaTransaction:
                 response = self.api.place_order(**order_data)
                 self.order_queue.remove(f"{remarks}_book_profit")
                 self.logger.info("Book Profit Order placed: %s", response)
-                self.logger.debug(
-                    "Book Profit Order placed: %s", json.dumps(order_data, indent=2)
-                )
+                self.logger.debug("Book Profit Order placed: %s", LazyJson(order_data))
                 msg = "Order placed"
             self.logger.debug(
                 "%s | LTP: %.2f | Price: %.2f | Diff Percent: %.2f %% | %s",
@@ -441,7 +484,7 @@ def main(args):
     show_strikes = args.show_strikes
     logger = configure_logger(args.log_level, f"shoonya_transaction_{index}")
 
-    logger.debug("Input Arguments: %s", json.dumps(vars(args), indent=2))
+    logger.debug("Input Arguments: %s", LazyJson(vars(args)))
     if not instance_id:
         instance_id = f"shoonya_{get_instance_id()}"
     else:
@@ -500,7 +543,7 @@ def main(args):
 
     logging.info(
         "Strikes data: %s | Max profit :%.2f | Max Loss : %.2f | Target : %.2f",
-        json.dumps(strikes_data, indent=2),
+        LazyJson(strikes_data),
         premium,
         max_loss,
         target_mtm,
@@ -515,95 +558,115 @@ def main(args):
 
     shoonya_transaction = ShoonyaTransaction(api_object=api, instance_id=instance_id)
 
-    while not shoonya_transaction.over():
-        for item in ["ce", "pe"]:
-            subscribe_msg = get_remarks(instance_id=instance_id, msg=f"{item}_straddle")
-
-            symbol = strikes_data[f"{item}_strike"]
-            ltp = float(strikes_data[f"{item}_ltp"])
-            code = f"{strikes_data[f'{item}_code']}"
-
-            sl_symbol = strikes_data[f"{item}_sl_strike"]
-            sl_ltp = float(strikes_data[f"{item}_sl_ltp"])
-            sl_ltp = round_to_point5(sl_ltp * sl_factor)
-            trigger = sl_ltp - 0.5
-            book_profit_ltp = round_to_point5(
-                min_ltp * book_profit
-            )  ## pylint: disable=unused-variable
-            code_sl = f"{strikes_data[f'{item}_sl_code']}"
-
-            shoonya_transaction.place_order(  ## Place straddle order
-                {
+    ## The strikes are fixed once placed, work out each leg once
+    legs = []
+    for item in ["ce", "pe"]:
+        symbol = strikes_data[f"{item}_strike"]
+        sl_symbol = strikes_data[f"{item}_sl_strike"]
+        sl_ltp = round_to_point5(float(strikes_data[f"{item}_sl_ltp"]) * sl_factor)
+        exchange = get_exchange(symbol)
+        sl_exchange = get_exchange(sl_symbol)
+        remarks = get_remarks(instance_id=instance_id, msg=f"{item}_straddle")
+        sl_remarks = f"{remarks}_stop_loss"
+        legs.append(
+            StraddleLeg(
+                remarks=remarks,
+                sl_remarks=sl_remarks,
+                order={
                     "buy_or_sell": "S",
                     "product_type": "M",  ## M for NRML, I for MIS
-                    "exchange": get_exchange(symbol),
+                    "exchange": exchange,
                     "tradingsymbol": symbol,
                     "quantity": qty,
                     "discloseqty": 0,
                     "price_type": "LMT",
-                    "price": ltp,
+                    "price": float(strikes_data[f"{item}_ltp"]),
                     "trigger_price": None,
                     "retention": "DAY",
-                    "remarks": subscribe_msg,
-                }
-            )
-            shoonya_transaction.subscribe(  ## Subscribe to straddle symbol, if executed
+                    "remarks": remarks,
+                },
                 symbol_data={
-                    "symbolcode": code,
-                    "exchange": get_exchange(symbol),
+                    "symbolcode": f"{strikes_data[f'{item}_code']}",
+                    "exchange": exchange,
                     "tradingsymbol": symbol,
                 },
-                remarks=f"{subscribe_msg}_subscribe",
-                parent_remarks=subscribe_msg,
-                parent_status=OrderStatus.COMPLETE,
-            )
-            shoonya_transaction.place_order(  ## Place stop loss order
-                order_data={
+                sl_order={
                     "buy_or_sell": "B",
                     "product_type": "M",  ## M for NRML, I for MIS
-                    "exchange": get_exchange(sl_symbol),
+                    "exchange": sl_exchange,
                     "tradingsymbol": sl_symbol,
                     "quantity": qty,
                     "discloseqty": 0,
                     "price_type": "SL-LMT",
                     "price": sl_ltp,
-                    "trigger_price": trigger,
+                    "trigger_price": sl_ltp - 0.5,
                     "retention": "DAY",
-                    "remarks": f"{subscribe_msg}_stop_loss",
+                    "remarks": sl_remarks,
                 },
-                parent_remarks=subscribe_msg,
-            )
-            shoonya_transaction.subscribe(  ## Subscribe to stop loss symbol, if executed
-                symbol_data={
-                    "symbolcode": code_sl,
-                    "exchange": get_exchange(sl_symbol),
+                sl_symbol_data={
+                    "symbolcode": f"{strikes_data[f'{item}_sl_code']}",
+                    "exchange": sl_exchange,
                     "tradingsymbol": sl_symbol,
                 },
-                remarks=f"{subscribe_msg}_stop_loss_subscribe",
-                parent_remarks=f"{subscribe_msg}_stop_loss",
+            )
+        )
+    book_profit_ltp = round_to_point5(
+        min_ltp * book_profit
+    )  ## pylint: disable=unused-variable
+
+    ## bound once, the loop runs until the day is over
+    over = shoonya_transaction.over
+    place_order = shoonya_transaction.place_order
+    subscribe = shoonya_transaction.subscribe
+    unsubscribe = shoonya_transaction.unsubscribe
+    cancel_on_book_profit = shoonya_transaction.cancel_on_book_profit
+    cancel_on_profit = shoonya_transaction.cancel_on_profit
+    display_stats = shoonya_transaction.display_stats
+    wait_for_update = shoonya_transaction.wait_for_update
+    target_loss = -1.0 * target_mtm * 1.33  ## Hardcoded
+
+    while not over():
+        for (
+            subscribe_msg,
+            sl_msg,
+            order,
+            symbol_data,
+            sl_order,
+            sl_symbol_data,
+        ) in legs:
+            place_order(order)  ## Place straddle order
+            subscribe(  ## Subscribe to straddle symbol, if executed
+                symbol_data=symbol_data,
+                remarks=f"{subscribe_msg}_subscribe",
+                parent_remarks=subscribe_msg,
                 parent_status=OrderStatus.COMPLETE,
             )
-            shoonya_transaction.cancel_on_book_profit(  ## Cancel stop loss order,
+            place_order(  ## Place stop loss order
+                order_data=sl_order,
+                parent_remarks=subscribe_msg,
+            )
+            subscribe(  ## Subscribe to stop loss symbol, if executed
+                symbol_data=sl_symbol_data,
+                remarks=f"{sl_msg}_subscribe",
+                parent_remarks=sl_msg,
+                parent_status=OrderStatus.COMPLETE,
+            )
+            cancel_on_book_profit(  ## Cancel stop loss order,
                 ## if book profit is COMPLETE
                 remarks=f"{subscribe_msg}_cancel",
                 parent_remarks=f"{subscribe_msg}_book_profit",
                 parent_status=OrderStatus.COMPLETE,
-                cancel_remarks=f"{subscribe_msg}_stop_loss",
+                cancel_remarks=sl_msg,
             )
-            shoonya_transaction.cancel_on_profit(
-                target_profit=redis_store.retrieve_param("target_mtm"),
-                target_loss=-1.0 * target_mtm * 1.33,  ## Hardcoded
+            cancel_on_profit(
+                redis_store=redis_store, target_loss=target_loss
             )  ## Cancel all orders if target is reached
             ## Exit if book profit is reached on each leg
             # shoonya_transaction.exit_on_book_profit()
-            shoonya_transaction.unsubscribe(  ## Unsubscribe from straddle symbol,
+            unsubscribe(  ## Unsubscribe from straddle symbol,
                 ## if exit order is placed or order is cancelled
                 ## or book profit order is executed
-                symbol_data={
-                    "symbolcode": code,
-                    "exchange": get_exchange(symbol),
-                    "tradingsymbol": symbol,
-                },
+                symbol_data=symbol_data,
                 remarks=f"{subscribe_msg}_unsubscribe",
                 parent_remarks=subscribe_msg,
             )
@@ -614,7 +677,11 @@ def main(args):
             # shoonya_transaction.modify_book_profit_sl(book_profit_factor=book_profit)
             ## Re-enqueue rejected order
             # shoonya_transaction.re_enqueue_rejected_order()
-            shoonya_transaction.display_stats()
+            display_stats()
+        ## nothing changes between order updates but the throttled checks
+        wait_for_update()
+    ## the last order updates, like the square off fills, reach the tables
+    shoonya_transaction.transaction_manager.stop_order_updates()
 
 
 def quick_test():
@@ -2,10 +2,11 @@
 Transaction manager
 """
 
-import datetime
-import json
 import logging
+import queue
 import sys
+import threading
+import time
 from contextlib import contextmanager
 from typing import Any
 from typing import Dict
@@ -16,10 +17,13 @@ import psycopg2.extras
 from const import OrderStatus
 from psycopg2.pool import PoolError
 from psycopg2.pool import ThreadedConnectionPool
+from utils import LazyJson
 from utils import full_stack
 from utils import log_execution_time
 
 import order_manager  ## pylint: disable=import-error
+from pnl import INSTANCE_PNL_QUERY  ## pylint: disable=import-error
+from pnl import summarize_pnl  ## pylint: disable=import-error
 
 
 class TransactionManager(order_manager.OrderManager):
@@ -31,6 +35,8 @@ class TransactionManager(order_manager.OrderManager):
         3  ## minimum number of connections in the pool, these are created instantly
     )
     MAX_CONNECTIONS = 10  ## maximum number of connections in the pool
+    FEED_FLUSH_INTERVAL = 0.05  ## seconds between batched liveltp upserts
+    FEED_ERROR_LIMIT = 10  ## consecutive bad ticks before shutting down
 
     @log_execution_time("Initiate TransactionManager")
     def __init__(self, api_object: Any, config: Dict):
@@ -54,10 +60,35 @@ class TransactionManager(order_manager.OrderManager):
             conn_string,
         )
 
-        ## get the current unix utc_timestamp using datetime
+        ## get the current unix utc_timestamp
         self.start_time = self._get_utc_timestamp()
         self.active_connections = 0
         self._create_tables()
+        ## remarks -> (norenordno, status), kept current by the order updates
+        self._remarks_index = {}
+        ## tradingsymbol -> symbolcode of the subscribed symbols
+        self._symbol_codes = {}
+
+        ## order updates are written to the tables off the websocket thread
+        self._order_updates = queue.Queue()
+        self._order_updates_thread = threading.Thread(
+            target=self._store_order_updates, name="order_updates", daemon=True
+        )
+        self._order_updates_thread.start()
+
+        ## set on every order update of this instance, see wait_for_order_update
+        self._order_evt = threading.Event()
+
+        ## latest ltp per symbolcode, written to liveltp in batches
+        self._tick_buf = {}
+        self._tick_lock = threading.Lock()
+        ## last ltp seen per symbolcode, written by the feed handler and
+        ## evicted by _flush_feed for ticks that failed to persist
+        self._last_lp = {}
+        self._feed_errors = 0
+        threading.Thread(
+            target=self._flush_feed, name="feed_flush", daemon=True
+        ).start()
 
     @contextmanager
     def getcursor(self):
@@ -86,7 +117,8 @@ class TransactionManager(order_manager.OrderManager):
 
     def _get_utc_timestamp(self):
         """Get the current utc_timestamp"""
-        return datetime.datetime.now().timestamp()
+        ## same value as datetime.now().timestamp(), without building a datetime
+        return time.time()
 
     def _create_tables(self):
         """Create a table transaction in the database"""
@@ -151,25 +183,105 @@ class TransactionManager(order_manager.OrderManager):
         """
         Event handler for order update
         """
-        remarks = order_data["remarks"]
+        ## orders placed outside the bot may carry no remarks at all
+        remarks = order_data.get("remarks", "")
         if not self._check_for_self(remarks):
-            logging.debug("Ignoring other instance order update %s", remarks)
+            self.logger.debug("Ignoring other instance order update %s", remarks)
             return
+        ## status is visible to get_for_remarks right away, the tables are
+        ## updated by _store_order_updates, see flush_order_updates
+        self._remarks_index[remarks] = (order_data["norenordno"], order_data["status"])
+        self._order_evt.set()
+        self._order_updates.put((order_data, self._get_utc_timestamp()))
+
+    def wait_for_order_update(self, timeout: float) -> bool:
+        """
+        Block until an order update of this instance arrives or the timeout
+        """
+        updated = self._order_evt.wait(timeout)
+        ## cleared before the caller reads the index, a later update sets it again
+        self._order_evt.clear()
+        return updated
+
+    def _store_order_updates(self):
+        """
+        Write the queued order updates to the tables, in arrival order
+        """
+        ## bound once, the loop runs for the whole session
+        get_update = self._order_updates.get
+        upsert = self._upsert_order_update
+        logger = self.logger
+        while True:
+            update = get_update()
+            if update is None:  ## queued by stop_order_updates, all written
+                return
+            if isinstance(update, threading.Event):  ## see flush_order_updates
+                update.set()
+                continue
+            order_data, utc_timestamp = update
+            try:
+                upsert(order_data, utc_timestamp)
+            except SystemExit:
+                ## getcursor exits on a lost connection, in this thread that
+                ## would only end the writer while the bot keeps trading
+                logger.error(
+                    "Order update lost the database, shutting down: %s",
+                    order_data.get("remarks"),
+                )
+                self._shutdown_evt.set()
+            except Exception as e:  ## pylint: disable=broad-except
+                logger.error("Exception: %s", e)
+                logger.error("Stack Trace : %s", full_stack())
+
+    def flush_order_updates(self, timeout: float = 5.0) -> bool:
+        """
+        Block until the order updates queued so far are in the tables,
+        called before reading transactions or order_prices
+        """
+        if not self._order_updates_thread.is_alive():
+            return self._order_updates.empty()
+        ## the queue is FIFO, the marker is set once every update before it
+        ## has been written
+        written = threading.Event()
+        self._order_updates.put(written)
+        if not written.wait(timeout):
+            self.logger.warning(
+                "Order updates not written after %.0f seconds: %d left",
+                timeout,
+                self._order_updates.qsize(),
+            )
+            return False
+        return True
+
+    def stop_order_updates(self, timeout: float = 10.0):
+        """
+        Write the order updates still queued before the process exits,
+        the writer is a daemon thread and would be dropped otherwise
+        """
+        self._order_updates.put(None)
+        self._order_updates_thread.join(timeout)
+        if self._order_updates_thread.is_alive():
+            self.logger.warning(
+                "Order updates not written after %.0f seconds: %d left",
+                timeout,
+                self._order_updates.qsize(),
+            )
 
+    def _upsert_order_update(self, order_data: Dict, utc_timestamp: float):
+        """
+        Upsert an order update into transactions and order_prices
+        """
+        remarks = order_data["remarks"]
         norenordno = order_data["norenordno"]
-        avgprice = -1
-        qty = -1
-        if "fillshares" in order_data and "flprc" in order_data:
-            avgprice = order_data["flprc"]
-            qty = order_data["fillshares"]
+        ## fill price once the order has fills, -1 until then
+        avgprice = order_data.get("flprc", -1) if "fillshares" in order_data else -1
         price = order_data["prc"]  ## always present
         qty = order_data["qty"]  ## always present
         buysell = order_data["trantype"]
         tradingsymbol = order_data["tsym"]
         status = order_data["status"]
-        utc_timestamp = self._get_utc_timestamp()
         ## upsert into the table transactions
-        upsert_data = {
+        transaction_data = {
             "norenordno": norenordno,
             "utc_timestamp": utc_timestamp,
             "remarks": remarks,
@@ -196,22 +308,20 @@ class TransactionManager(order_manager.OrderManager):
                 status = %(status)s,
                 instance = %(instance)s
                 """,
-                upsert_data,
+                transaction_data,
+            )
+            self.logger.debug(
+                "Upserting into table transactions: %s", LazyJson(transaction_data)
             )
-            cursor.connection.commit()
-        self.logger.debug(
-            "Upserting into table transactions: %s", json.dumps(upsert_data, indent=2)
-        )
 
-        ## update the order_prices table
-        upsert_data = {
-            "tradingsymbol": tradingsymbol,
-            "price": price,
-            "qty": qty,
-            "remarks": remarks,
-            "instance": self.instance_id,
-        }
-        with self.getcursor() as cursor:
+            ## update the order_prices table, in the same transaction
+            upsert_data = {
+                "tradingsymbol": tradingsymbol,
+                "price": price,
+                "qty": qty,
+                "remarks": remarks,
+                "instance": self.instance_id,
+            }
             ## traddingsymbol and instance are primary keys
             cursor.execute(
                 """INSERT INTO order_prices
@@ -227,33 +337,89 @@ class TransactionManager(order_manager.OrderManager):
             cursor.connection.commit()
         self.logger.debug(
             "Upserting into table order_prices: %s",
-            json.dumps(upsert_data, indent=2),
+            LazyJson(upsert_data),
         )
 
     def _event_handler_feed_update(self, tick_data: Dict):
         """
         Event handler for feed update
         """
+        ## depth and acknowledgement frames carry no ltp, nothing to do
+        lp = tick_data.get("lp")
+        if lp is None:
+            return
         try:
-            if "lp" in tick_data:
-                lp = float(tick_data["lp"])
-                tk = tick_data["tk"]
+            lp = float(lp)
+            tk = tick_data["tk"]
+            ## repeated quotes of the same price have nothing to write
+            if self._last_lp.get(tk) == lp:
+                return
+            self._last_lp[tk] = lp
+            ## only the latest tick per symbol is kept, see _flush_feed
+            with self._tick_lock:
+                self._tick_buf[tk] = lp
+            if self._feed_errors:
+                self._feed_errors = 0
+        except Exception as e:  ## pylint: disable=broad-except
+            self.logger.error("Exception: %s", e)
+            self.logger.error("Stack Trace : %s", full_stack())
+            ## a bad tick is dropped, only a feed that keeps failing stops the bot
+            self._feed_errors += 1
+            if self._feed_errors >= TransactionManager.FEED_ERROR_LIMIT:
+                ## sys.exit would only end the websocket thread,
+                ## the main loop stops on shutting_down instead
+                self._shutdown_evt.set()
+
+    def _flush_feed(self):
+        """
+        Upsert the buffered ticks into liveltp, one statement per interval
+        """
+        ## bound once, the loop runs for the whole session
+        sleep = time.sleep
+        interval = TransactionManager.FEED_FLUSH_INTERVAL
+        tick_lock = self._tick_lock
+        getcursor = self.getcursor
+        execute_values = psycopg2.extras.execute_values
+        ## the two tick buffers are swapped in turn, no dict per flush
+        spare = {}
+        while True:
+            sleep(interval)
+            with tick_lock:
+                if not self._tick_buf:
+                    continue
+                ticks, self._tick_buf = self._tick_buf, spare
+            try:
                 ## upsert into the table liveltp
-                with self.getcursor() as cursor:
-                    cursor.execute(
+                with getcursor() as cursor:
+                    execute_values(
+                        cursor,
                         """INSERT INTO liveltp
                         (symbolcode, ltp)
-                        VALUES (%(tk)s, %(lp)s)
+                        VALUES %s
                         ON CONFLICT (symbolcode) DO UPDATE
-                        SET ltp = %(lp)s
+                        SET ltp = EXCLUDED.ltp
                         """,
-                        {"tk": tk, "lp": lp},
+                        list(ticks.items()),
                     )
                     cursor.connection.commit()
-        except Exception as e:  ## pylint: disable=broad-except
-            self.logger.error("Exception: %s", e)
-            self.logger.error("Stack Trace : %s", full_stack())
-            sys.exit(-1)
+            except SystemExit:
+                ## getcursor exits on a lost connection, in this thread that
+                ## would only end the flusher while the bot keeps trading
+                self.logger.error("Feed flush lost the database, shutting down")
+                self._shutdown_evt.set()
+                return
+            except Exception as e:  ## pylint: disable=broad-except
+                self.logger.error("Exception: %s", e)
+                self.logger.error("Stack Trace : %s", full_stack())
+                ## retry the unsent ticks next flush, newer ticks already
+                ## buffered for a symbol win. Their prices are not in liveltp,
+                ## a repeat of the same price must not be skipped
+                with tick_lock:
+                    for tk, lp in ticks.items():
+                        self._tick_buf.setdefault(tk, lp)
+                        self._last_lp.pop(tk, None)
+            ticks.clear()
+            spare = ticks
 
     @log_execution_time("Subscribe")
     def subscribe_symbols(self, symbol: Dict):
@@ -265,6 +431,7 @@ class TransactionManager(order_manager.OrderManager):
         tradingsymbol = symbol["tradingsymbol"]
         subscribe_code = f"{exchange}|{symbolcode}"
         self.subscribe(subscribe_code)
+        self._symbol_codes[tradingsymbol] = symbolcode
 
         ## upsert into the table symbols
         upsert_data = {
@@ -273,9 +440,7 @@ class TransactionManager(order_manager.OrderManager):
             "tradingsymbol": tradingsymbol,
             "instance": self.instance_id,
         }
-        self.logger.info(
-            "Upserting into table symbols %s", json.dumps(upsert_data, indent=2)
-        )
+        self.logger.info("Upserting into table symbols %s", LazyJson(upsert_data))
         with self.getcursor() as cursor:
             cursor.execute(
                 """INSERT INTO symbols
@@ -306,28 +471,31 @@ class TransactionManager(order_manager.OrderManager):
         Get norenordno if order executed for remark,
         for utc_timestamp greater than start_time, otherwise None
         """
-        response = None
-        with self.getcursor() as cursor:
-            try:
-                cursor.execute(
-                    """SELECT norenordno, status
-                    FROM transactions
-                    WHERE remarks=%s AND instance=%s
-                    """,
-                    (remarks, self.instance_id),
-                )
-                response = cursor.fetchone()
-            except psycopg2.OperationalError as ex:
-                self.logger.error("Exception: %s", ex)
-                ## stacktrace
-                self.logger.error(full_stack())
+        response = self._remarks_index.get(remarks)
+        if response is None:
+            ## not updated in this process, e.g. a previous instance
+            with self.getcursor() as cursor:
+                try:
+                    cursor.execute(
+                        """SELECT norenordno, status
+                        FROM transactions
+                        WHERE remarks=%s AND instance=%s
+                        """,
+                        (remarks, self.instance_id),
+                    )
+                    response = cursor.fetchone()
+                except psycopg2.OperationalError as ex:
+                    self.logger.error("Exception: %s", ex)
+                    ## stacktrace
+                    self.logger.error(full_stack())
+            if response is not None:
+                self._remarks_index.setdefault(remarks, tuple(response))
 
         if response is not None:
-            norenordno = response.norenordno
-            status = response.status
+            norenordno, status = response
             expected_list = expected
             if expected and isinstance(expected, OrderStatus):
-                expected_list = [expected.value]
+                expected_list = [expected]
             if expected is None or status in expected_list:
                 return norenordno, OrderStatus(status)
         return None, None
@@ -335,60 +503,23 @@ class TransactionManager(order_manager.OrderManager):
     @log_execution_time("PnL")
     def get_pnl(self) -> Tuple[float, Dict]:
         """
-        Get PnL for all orders, use all three tables,
-            liveltp has live prices and symbolcode,
-            transactions has avgprice, qty, buysell, tradingsymbol. It does not have symbolcode
-            symbols has symbolcode, exchange, tradingsymbol
-        Note: symbolcode is not tradingsymbol
+        Get PnL for all orders of this instance, see pnl.PNL_QUERY
         """
+        self.flush_order_updates()
         rows = []
         try:
             with self.getcursor() as cursor:
-                cursor.execute(
-                    """SELECT transactions.avgprice, transactions.qty, transactions.buysell, 
-                            transactions.tradingsymbol, liveltp.ltp
-                    FROM transactions
-                    JOIN symbols ON transactions.instance = symbols.instance 
-                                    AND transactions.tradingsymbol = symbols.tradingsymbol
-                    JOIN liveltp ON symbols.symbolcode = liveltp.symbolcode
-                    WHERE transactions.instance = %s""",
-                    (self.instance_id,),
-                )
+                cursor.execute(INSTANCE_PNL_QUERY, (self.instance_id,))
                 rows = cursor.fetchall()
         except Exception as e:  ## pylint: disable=broad-exception-caught
             self.logger.error("Failed to execute SQL query %s", e)
             self.logger.error(full_stack())
             return -999.999
-        total_pnl = 0
-        msg = {}
-        for row in rows:
-            avgprice = round(float(row.avgprice), 2)
-            qty = int(row.qty)
-            buysell = row.buysell
-            tradingsymbol = row.tradingsymbol
-            ltp = round(float(row.ltp), 2)
-            if avgprice == -1 or qty == -1:
-                continue
-            if buysell == "B":
-                pnl = (ltp - avgprice) * qty
-            else:
-                pnl = (avgprice - ltp) * qty
-            total_pnl += pnl
-            msg[tradingsymbol] = {
-                "buysell": buysell,
-                "qty": int(qty),
-                "avgprice": avgprice,
-                "ltp": ltp,
-                "pnl": round(pnl, 2),
-            }
-        if msg:
-            ## sort msg by key
-            msg = dict(sorted(msg.items()))
-            msg["Total"] = round(total_pnl, 2)
-        return total_pnl, msg
+        return summarize_pnl(rows)
 
     def get_orders(self) -> List[Dict]:
         """Get all orders for this instance"""
+        self.flush_order_updates()
         rows = []
         try:
             with self.getcursor() as cursor:
@@ -443,15 +574,27 @@ class TransactionManager(order_manager.OrderManager):
         """
         Get the last traded price of the symbol
         """
+        symbolcode = self._symbol_codes.get(tradingsymbol)
+        ## ticked since subscribing, the feed is newer than liveltp
+        ltp = self._last_lp.get(symbolcode)
+        if ltp is not None:
+            return ltp
         with self.getcursor() as cursor:
-            cursor.execute(
-                """SELECT ltp
-                FROM liveltp
-                JOIN symbols ON liveltp.symbolcode = symbols.symbolcode
-                WHERE symbols.tradingsymbol = %s AND symbols.instance = %s
-                """,
-                (tradingsymbol, self.instance_id),
-            )
+            if symbolcode is not None:
+                ## subscribed by this process, no need to join symbols
+                cursor.execute(
+                    """SELECT ltp FROM liveltp WHERE symbolcode = %s""",
+                    (symbolcode,),
+                )
+            else:
+                cursor.execute(
+                    """SELECT ltp
+                    FROM liveltp
+                    JOIN symbols ON liveltp.symbolcode = symbols.symbolcode
+                    WHERE symbols.tradingsymbol = %s AND symbols.instance = %s
+                    """,
+                    (tradingsymbol, self.instance_id),
+                )
             row = cursor.fetchone()
             if row is not None:
                 return float(row.ltp)
@@ -461,6 +604,7 @@ class TransactionManager(order_manager.OrderManager):
         """
         Get the order price and quantity of the symbol
         """
+        self.flush_order_updates()
         with self.getcursor() as cursor:
             cursor.execute(
                 """SELECT price, qty
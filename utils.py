@@ -3,6 +3,7 @@ Utility functions for the project shoonya trading
 """
 import argparse
 import datetime
+import json
 import logging
 import os
 import pathlib
@@ -10,21 +11,41 @@ import sys
 import time
 import traceback
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from functools import wraps
 
 import colorlog
 import pandas as pd
+import pyarrow.parquet as pq
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  ## the stdlib encoder is used instead
+    orjson = None
 
 from const import EXCHANGE
-from const import INDICES_ROUNDING
 from const import INDICES_TOKEN
+from const import INSTRUMENTS
 from const import LOT_SIZE
-from const import SCRIP_SYMBOL_NAME
 
 logger = logging.getLogger(__name__)
 
+## Kept alive across downloads, transient failures are retried with backoff
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    ),
+)
+
 
 def log_execution_time(message):
     """Log the execution time of the function"""
@@ -43,6 +64,27 @@ def log_execution_time(message):
     return decorator
 
 
+class LazyJson:
+    """
+    Log argument rendering an object as indented json, the serialization
+    runs only if the record is emitted. Uses orjson's native encoder,
+    which also takes the numpy scalars coming out of pandas, and falls
+    back to the stdlib json if orjson is not installed
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        if orjson is None:
+            return json.dumps(self.obj, indent=2, default=str)
+        return orjson.dumps(
+            self.obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+        ).decode()
+
+
 def round_to_point5(x):
     """
     Round to nearest 0.5
@@ -127,6 +169,23 @@ def configure_logger(log_level, prefix_log_file: str = "shoonya_daily_short"):
     return logging.getLogger(prefix_log_file)
 
 
+## Scrip masters already loaded by this process, keyed by (file_id, date)
+_SCRIP_MASTER_CACHE = {}
+## Columns of the scrip master used for strike selection, the rest is not parsed.
+## The equity and index masters have no option columns, only the ones present
+## in a file are read
+SCRIP_MASTER_COLUMNS = [
+    "Token",
+    "Symbol",
+    "TradingSymbol",
+    "Expiry",
+    "OptionType",
+    "StrikePrice",
+]
+## Few distinct values repeated on every row
+SCRIP_MASTER_DTYPES = {"Symbol": "category", "OptionType": "category"}
+
+
 def download_scrip_master(file_id="NFO_symbols"):
     """
     Download the scrip master from the Shoonya endpoint website
@@ -135,11 +194,25 @@ def download_scrip_master(file_id="NFO_symbols"):
             Instrument,OptionType,StrikePrice,TickSize
     file_id: NFO_symbols, CDS_symbols, BSE_symbols, NSE_symbols,\
         BFO_symbols, MCX_symbols
+    The parsed file is kept as parquet next to the text file and in memory,
+    so the csv is parsed at most once a day
     """
     today = datetime.datetime.now().strftime("%Y%m%d")
+    cached = _SCRIP_MASTER_CACHE.get((file_id, today))
+    if cached is not None:
+        return cached
     downloads_folder = "./downloads"
     zip_file_name = f"{downloads_folder}/{file_id}.txt_{today}.zip"
     todays_nse_fo = f"{downloads_folder}/{file_id}.{today}.txt"
+    todays_parquet = f"{downloads_folder}/{file_id}.{today}.parquet"
+    if os.path.exists(todays_parquet):
+        present = pq.read_schema(todays_parquet).names
+        df = pd.read_parquet(
+            todays_parquet,
+            columns=[column for column in SCRIP_MASTER_COLUMNS if column in present],
+        )
+        _SCRIP_MASTER_CACHE[(file_id, today)] = df
+        return df
 
     ## unzip and read the file
     ## create a download folder, if not exists
@@ -148,7 +221,7 @@ def download_scrip_master(file_id="NFO_symbols"):
     if not os.path.exists(todays_nse_fo):
         shoonya_url = f"https://api.shoonya.com/{file_id}.txt.zip"
         logger.info("Downloading file %s", shoonya_url)
-        nse_fo = requests.get(shoonya_url, timeout=15)
+        nse_fo = HTTP_SESSION.get(shoonya_url, timeout=15)
         if nse_fo.status_code != 200:
             logger.error("Could not download file")
             return None
@@ -162,7 +235,14 @@ def download_scrip_master(file_id="NFO_symbols"):
         os.remove(zip_file_name)
         ## rename the file with date suffix
         os.rename(f"{downloads_folder}/{file_id}.txt", todays_nse_fo)
-    df = pd.read_csv(todays_nse_fo, sep=",")
+    df = pd.read_csv(
+        todays_nse_fo,
+        sep=",",
+        usecols=lambda column: column in SCRIP_MASTER_COLUMNS,
+        dtype=SCRIP_MASTER_DTYPES,
+    )
+    df.to_parquet(todays_parquet)
+    _SCRIP_MASTER_CACHE[(file_id, today)] = df
     return df
 
 
@@ -181,6 +261,7 @@ def refresh_indices_code():
     for index_name, index_value in indices_symbols:
         token = data_frame[data_frame["Symbol"] == index_name]["Token"].values[0]
         INDICES_TOKEN[index_value] = token
+        INSTRUMENTS[index_value] = INSTRUMENTS[index_value]._replace(token=token)
 
     ## BSE Futures & Options symbols
     data_frame = download_scrip_master(file_id="CDS_symbols")
@@ -193,6 +274,7 @@ def refresh_indices_code():
     for index_name, index_value in indices_symbols:
         token = data_frame[data_frame["Symbol"] == index_name]["Token"].values[0]
         INDICES_TOKEN[index_value] = token
+        INSTRUMENTS[index_value] = INSTRUMENTS[index_value]._replace(token=token)
 
 
 def get_index(tradingsymbol):
@@ -204,9 +286,11 @@ def get_index(tradingsymbol):
     ]
 
 
+@lru_cache(maxsize=256)
 def get_exchange(tradingsymbol, is_index=False):
     """
-    Get the exchange from the trading symbol
+    Get the exchange from the trading symbol, memoized as the
+    symbols traded in a session are few and never change exchange
     """
     if is_index:
         if tradingsymbol in ["NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY"]:
@@ -245,17 +329,32 @@ def get_closest_expiry(symbol_index):
     """
     Get the closest expiry date
     """
-    df = download_scrip_master(file_id=f"{EXCHANGE[symbol_index]}_symbols")
-    scrip_symbol_name = SCRIP_SYMBOL_NAME[symbol_index]
-    df = df[df["Symbol"] == scrip_symbol_name]
-    df["Expiry"] = pd.to_datetime(df["Expiry"], format="%d-%b-%Y")
-    df["diff"] = df["Expiry"] - datetime.datetime.now()
-    df["diff"] = df["diff"].abs()
-    df = df.sort_values(by="diff")
-    expiry_date = df.iloc[0]["Expiry"]
+    spec = INSTRUMENTS[symbol_index]
+    df = download_scrip_master(file_id=f"{spec.exchange}_symbols")
+    df = df[df["Symbol"] == spec.scrip]
+    ## parse each distinct expiry once and pick the closest, no sort of the rows
+    expiries = df["Expiry"].unique()
+    expiry_dates = pd.to_datetime(expiries, format="%d-%b-%Y")
+    closest = abs(expiry_dates - datetime.datetime.now()).argmin()
+    expiry_date = expiry_dates[closest]
+    ## only the closest expiry is needed for the strike lookups
+    df = df[df["Expiry"] == expiries[closest]].assign(Expiry=expiry_date)
     return expiry_date, df
 
 
+def get_quotes_concurrently(shoonya_api, exchange, tokens):
+    """
+    Get the quotes of the tokens with one request in flight per token,
+    the quote requests are independent and bound by the round trip
+    """
+    with ThreadPoolExecutor(max_workers=len(tokens)) as executor:
+        futures = [
+            executor.submit(shoonya_api.get_quotes, exchange=exchange, token=str(token))
+            for token in tokens
+        ]
+        return [future.result() for future in futures]
+
+
 ## pylint: disable=too-many-locals
 @log_execution_time("get_staddle_strike")
 def get_staddle_strike(shoonya_api, symbol_index, qty=-1):
@@ -264,52 +363,43 @@ def get_staddle_strike(shoonya_api, symbol_index, qty=-1):
     """
     ## convert to 06DEC23
     expiry_date, df = get_closest_expiry(symbol_index)
+    spec = INSTRUMENTS[symbol_index]
+    exchange = spec.exchange
+    rounding = spec.rounding
     ret = shoonya_api.get_quotes(
         exchange=get_exchange(symbol_index, is_index=True),
-        token=str(INDICES_TOKEN[symbol_index]),
+        token=str(spec.token),
     )
     if ret:
         ltp = float(ret["lp"])
-        ## round to nearest INDICES_ROUNDING
-        nearest = (
-            round(ltp / INDICES_ROUNDING[symbol_index]) * INDICES_ROUNDING[symbol_index]
-        )
+        ## round to nearest rounding of the index
+        nearest = round(ltp / rounding) * rounding
         logger.info("LTP %.2f | Nearest %.2f", ltp, nearest)
         ce_strike = get_strike_tsym(df, expiry_date, nearest, "CE")
         pe_strike = get_strike_tsym(df, expiry_date, nearest, "PE")
         logger.info("CE Strike %s | PE Strike %s", ce_strike, pe_strike)
-        ## find the token for the strike
-        ce_token = df[df["TradingSymbol"] == ce_strike]["Token"].values[0]
-        pe_token = df[df["TradingSymbol"] == pe_strike]["Token"].values[0]
-        ce_quotes = shoonya_api.get_quotes(
-            exchange=EXCHANGE[symbol_index], token=str(ce_token)
-        )
-        pe_quotes = shoonya_api.get_quotes(
-            exchange=EXCHANGE[symbol_index], token=str(pe_token)
+        ## find the token for the strike, one pass over the expiry's rows
+        ## serves both the straddle and the stop loss strikes
+        tokens = dict(zip(df["TradingSymbol"], df["Token"]))
+        ce_token = tokens[ce_strike]
+        pe_token = tokens[pe_strike]
+        ce_quotes, pe_quotes = get_quotes_concurrently(
+            shoonya_api, exchange, [ce_token, pe_token]
         )
         premium = float(ce_quotes["lp"]) + float(pe_quotes["lp"])
         ## get sl strike as straddle minus premium collected roundede to
-        ## nearest INDICES_ROUNDING[symbol_index]
-        ce_sl = (
-            round((nearest + premium) / INDICES_ROUNDING[symbol_index])
-            * INDICES_ROUNDING[symbol_index]
-        )
-        pe_sl = (
-            round((nearest - premium) / INDICES_ROUNDING[symbol_index])
-            * INDICES_ROUNDING[symbol_index]
-        )
+        ## nearest rounding of the index
+        ce_sl = round((nearest + premium) / rounding) * rounding
+        pe_sl = round((nearest - premium) / rounding) * rounding
         logger.debug("CE SL %.2f | PE SL %.2f", ce_sl, pe_sl)
         ce_sl_strike = get_strike_tsym(df, expiry_date, ce_sl, "CE")
         pe_sl_strike = get_strike_tsym(df, expiry_date, pe_sl, "PE")
         logger.info("CE SL Strike %s | PE SL Strike %s", ce_sl_strike, pe_sl_strike)
         ## find the token for the strike
-        ce_sl_token = df[df["TradingSymbol"] == ce_sl_strike]["Token"].values[0]
-        pe_sl_token = df[df["TradingSymbol"] == pe_sl_strike]["Token"].values[0]
-        ce_sl_quotes = shoonya_api.get_quotes(
-            exchange=EXCHANGE[symbol_index], token=str(ce_sl_token)
-        )
-        pe_sl_quotes = shoonya_api.get_quotes(
-            exchange=EXCHANGE[symbol_index], token=str(pe_sl_token)
+        ce_sl_token = tokens[ce_sl_strike]
+        pe_sl_token = tokens[pe_sl_strike]
+        ce_sl_quotes, pe_sl_quotes = get_quotes_concurrently(
+            shoonya_api, exchange, [ce_sl_token, pe_sl_token]
         )
         ce_sl_ltp = float(ce_sl_quotes["lp"])
         pe_sl_ltp = float(pe_sl_quotes["lp"])
@@ -325,12 +415,12 @@ def get_staddle_strike(shoonya_api, symbol_index, qty=-1):
         ## get expiry date in 04-JAN-2024 format
         expiry_date = expiry_date.strftime("%d-%b-%Y").upper()
         if qty == -1:
-            qty = LOT_SIZE[symbol_index]
+            qty = spec.lot_size
 
         positions = [
             {
                 "prd": "H",
-                "exch": EXCHANGE[symbol_index],
+                "exch": exchange,
                 "instname": "OPTSTK",
                 "symname": symbol_index,
                 "exd": expiry_date,
@@ -342,7 +432,7 @@ def get_staddle_strike(shoonya_api, symbol_index, qty=-1):
             },
             {
                 "prd": "H",
-                "exch": EXCHANGE[symbol_index],
+                "exch": exchange,
                 "instname": "OPTSTK",
                 "symname": symbol_index,
                 "exd": expiry_date,
@@ -474,13 +564,14 @@ def delay_decorator(delay):
     """Decorator that ensures function can't be called more often than delay seconds."""
 
     def decorator(func):
-        # Store the time the function was last called
-        last_called = [0]
+        # Store the time the function was last called, monotonic clock so
+        # that wall clock adjustments neither skip nor repeat a call
+        last_called = [float("-inf")]
 
         @wraps(func)
         def wrapper(*args, **kwargs):
             # Get the current time
-            now = time.time()
+            now = time.monotonic()
             # If enough time has passed since the last call, call the function
             if now - last_called[0] > delay:
                 result = func(*args, **kwargs)
@@ -543,9 +634,7 @@ if __name__ == "__main__":
             "netqty": "-300",
         }
     ]
-    import json
-
     span_response = api.span_calculator("N/A", positions=positions_for_span)
     logger.info(
-        json.dumps(span_response, indent=3)
+        "%s", LazyJson(span_response)
     )  ## Error in span calculation for BFO, NFO works